@@ -45,7 +45,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import sys
+import inspect
 import warnings 
+import functools
 from mpl_toolkits.mplot3d import Axes3D
 
 
@@ -59,16 +61,217 @@ except:
 import matplotlib.pyplot  as plt
 from matplotlib.colors import LightSource
 import numpy as np
-from scipy import fftpack as fft
+from scipy import fft
 import scipy.sparse as sp
-from scipy.sparse.linalg import spsolve
-import random
+from scipy.sparse.linalg import factorized, cg
 
+# keyword of the relative tolerance of cg(): rtol since SciPy 1.12, 
+# tol before (removed in SciPy 1.14).
+_cg_tol_keyword = 'rtol' if 'rtol' in inspect.signature(cg).parameters else 'tol'
+
+has_numba = False
+try:
+    from numba import njit, prange, get_num_threads
+    has_numba = True
+except ImportError:
+    pass
+
+has_cholmod = False
+try:
+    from sksparse.cholmod import cholesky
+    has_cholmod = True
+except ImportError:
+    pass
+
+has_pyamg = False
+try:
+    from pyamg import smoothed_aggregation_solver
+    has_pyamg = True
+except ImportError:
+    pass
+
+@functools.lru_cache(maxsize=1)
+def _has_torch_cuda():
+    """
+    Whether PyTorch is installed with a usable CUDA GPU. torch is only 
+    imported at the first call, by the RANSAC runs large enough to use it,
+    as its import is slow. Broken CUDA installs raise other errors than 
+    ImportError, they mean no GPU too.
+    """
+    global torch
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except Exception:
+        return False
+
+# default random generator of ransac_3dvector(), created once, not at 
+# each call.
+_rng = np.random.default_rng()
+
+
+
+
+# Below this number of systems, _solve3() calls batched LAPACK routines, 
+# whose fixed cost is lower than the many small array operations of the 
+# closed form. Above, the closed form is faster (measured crossover).
+_cramer_min_systems = 64
+
+
+def _solve3(s, b):
+    """
+    Solution of 3x3 linear system(s) s.x = b, in closed form (Cramer's 
+    rule) for large stacks, by batched LAPACK calls for small ones.
+    Arguments:
+    ----------
+    s : numpy array
+        (..., 3, 3) stack of matrices.
+    b : numpy array
+        (..., 3) stack of right hand sides.
+    Returns:
+    --------
+        det, x: the (...) determinants of s and the (..., 3) solutions. x
+        is NaN where det is 0.
+    """
+    if s[..., 0, 0].size < _cramer_min_systems:
+        det = np.linalg.det(s)
+        x = np.full(b.shape, np.nan)
+        regular = det != 0
+        x[regular] = np.linalg.solve(s[regular], b[regular][..., None])[..., 0]
+        return det, x
+
+    a00, a01, a02, a10, a11, a12, a20, a21, a22 = np.moveaxis(
+        s.reshape(s.shape[:-2] + (9,)), -1, 0)
+    b0, b1, b2 = np.moveaxis(b, -1, 0)
+    # first column of cofactors, reused for the determinant
+    c00 = a11*a22 - a12*a21
+    c10 = a12*a20 - a10*a22
+    c20 = a10*a21 - a11*a20
+    det = a00*c00 + a01*c10 + a02*c20
+    # adjugate(s) @ b
+    adj_b = np.stack((b0*c00 + b1*(a02*a21 - a01*a22) + b2*(a01*a12 - a02*a11),
+                      b0*c10 + b1*(a00*a22 - a02*a20) + b2*(a02*a10 - a00*a12),
+                      b0*c20 + b1*(a01*a20 - a00*a21) + b2*(a00*a11 - a01*a10)), axis=-1)
+    x = np.divide(adj_b, det[..., None], out=np.full_like(adj_b, np.nan), 
+                  where=det[..., None] != 0)
+    return det, x
+
+
+def _ransac_trials(frac_inliers, p, n_model_points):
+    """
+    Number of trials k needed to pick, with probability p, at least one 
+    sample of n_model_points inliers when their fraction is frac_inliers 
+    (same name as in Fishler-Bolles).
+    """
+    # p_outliers is the 1 - b of Fishler-Bolles
+    p_outliers = 1 - frac_inliers**n_model_points
+    # preveny NaN/Inf  in estimation of k
+    eps = np.spacing(p_outliers)
+    p_outliers = min(1-eps, max(eps, p_outliers))
+    return np.log(1-p)/np.log(p_outliers)
+
+
+def _count_inliers(M, S, I, threshold):
+    """
+    Number of inliers |I - S.m| <= threshold of each candidate model m, row
+    of M. The (len(M), len(I)) fitting values are computed in place.
+    """
+    fit = M @ S.T
+    np.subtract(I, fit, out=fit)
+    np.abs(fit, out=fit)
+    return (fit <= threshold).sum(axis=1)
 
 
+def _solve3_torch(S_t, I_t, idx):
+    """
+    GPU version of _solve3(S[idx], I[idx]) for a block of triplets idx of 
+    ransac_3dvector(), with S_t and I_t the data as torch tensors on the 
+    device.
+    Returns:
+    --------
+        det, M: (n_block,) and (n_block, 3) ndarrays. M is meaningless 
+        where det is 0.
+    """
+    idx_t = torch.as_tensor(idx, device=S_t.device)
+    s = S_t[idx_t]
+    det = torch.linalg.det(s)
+    # solve_ex does not fail on singular matrices, unlike solve
+    M = torch.linalg.solve_ex(s, I_t[idx_t].unsqueeze(-1))[0].squeeze(-1)
+    return det.cpu().numpy(), M.cpu().numpy()
+
+
+def _count_inliers_torch(M, S_t, I_t, threshold):
+    """
+    GPU version of _count_inliers(), with S_t and I_t the data as torch 
+    tensors on the device. Only the models and the scores are moved.
+    """
+    M_t = torch.as_tensor(M, device=S_t.device)
+    scores = ((I_t[None, :] - M_t @ S_t.T).abs() <= threshold).sum(dim=1)
+    return scores.cpu().numpy()
+
+
+if has_numba:
+    @njit(cache=True)
+    def _solve3_numba(S, I, idx):
+        """
+        Numba version of _solve3(S[idx], I[idx]) for a block of triplets 
+        idx of ransac_3dvector(), without the gathers.
+        Returns:
+        --------
+            det, M: (n_block,) and (n_block, 3) arrays, NaN models where
+            det is 0.
+        """
+        n_block = idx.shape[0]
+        det = np.empty(n_block)
+        M = np.full((n_block, 3), np.nan)
+        for h in range(n_block):
+            i0, i1, i2 = idx[h, 0], idx[h, 1], idx[h, 2]
+            a00, a01, a02 = S[i0, 0], S[i0, 1], S[i0, 2]
+            a10, a11, a12 = S[i1, 0], S[i1, 1], S[i1, 2]
+            a20, a21, a22 = S[i2, 0], S[i2, 1], S[i2, 2]
+            # Cramer's rule, with the cofactors c_ij of s
+            c00 = a11*a22 - a12*a21
+            c01 = a12*a20 - a10*a22
+            c02 = a10*a21 - a11*a20
+            d = a00*c00 + a01*c01 + a02*c02
+            det[h] = d
+            if d == 0.0:
+                continue
+            c10 = a02*a21 - a01*a22
+            c11 = a00*a22 - a02*a20
+            c12 = a01*a20 - a00*a21
+            c20 = a01*a12 - a02*a11
+            c21 = a02*a10 - a00*a12
+            c22 = a00*a11 - a01*a10
+            b0, b1, b2 = I[i0], I[i1], I[i2]
+            M[h, 0] = (c00*b0 + c10*b1 + c20*b2)/d
+            M[h, 1] = (c01*b0 + c11*b1 + c21*b2)/d
+            M[h, 2] = (c02*b0 + c12*b1 + c22*b2)/d
+        return det, M
+
+
+    @njit(parallel=True, cache=True)
+    def _count_inliers_numba(M, S, I, threshold):
+        """
+        Numba version of _count_inliers(), in parallel over the candidate
+        models and without the (len(M), len(I)) fitting values.
+        """
+        n_models = M.shape[0]
+        ndata = S.shape[0]
+        scores = np.zeros(n_models, dtype=np.int64)
+        for h in prange(n_models):
+            m0, m1, m2 = M[h, 0], M[h, 1], M[h, 2]
+            count = 0
+            for j in range(ndata):
+                if abs(I[j] - (S[j, 0]*m0 + S[j, 1]*m1 + S[j, 2]*m2)) <= threshold:
+                    count += 1
+            scores[h] = count
+        return scores
+
 
 def ransac_3dvector(data, threshold, max_data_tries=100, max_iters=1000, 
-                    p=0.9, det_threshold=1e-1, verbose=2):
+                    p=0.9, det_threshold=1e-1, verbose=2, block_size=256,
+                    rng=None):
     """
     A RANSAC implementation for fitting a vector in a linear model I = s.m
     with I a scalar, s a 3D vector and m the vector to be fitted. 
@@ -94,6 +297,14 @@ def ransac_3dvector(data, threshold, max_data_tries=100, max_iters=1000,
         threshold to decide wether a determinant (in absolute value) is large enough.
     verbose: int
         0 = silent, 1 = some comments, >= 2: a lot of things
+    block_size: int (optional, default=256)
+        number of candidate models sampled, solved and scored together in
+        one vectorized pass (at most). Blocks are no larger than the 
+        current estimate of the number of trials still needed, starting 
+        with a single candidate.
+    rng: numpy.random.Generator, int or None (optional, default=None)
+        random generator used to sample the data, or seed of a new one,
+        for reproducible runs. If None, a generator shared by the calls.
 
     Returns:
     --------
@@ -113,7 +324,6 @@ def ransac_3dvector(data, threshold, max_data_tries=100, max_iters=1000,
 
 
     # minimum number of  points to select a model
-    global s
     n_model_points = 3
     
     # initialisation of model to None,
@@ -132,112 +342,187 @@ def ransac_3dvector(data, threshold, max_data_tries=100, max_iters=1000,
     # with probability p. Will be updated during the run (same name 
     # as in Fishler-Bolles.
     k = 1 
+
+    # number of consecutive samples rejected as degenerate
+    n_failed = 0
+
+    # numbers of sampled triplets and of non degenerate ones among them
+    n_drawn = 0
+    n_regular = 0
     
     I, S = data
     #S = S.T
     S = S.copy().astype(float)
     I = I.copy().astype(float)
     ndata = len(I)
+    rng = _rng if rng is None else np.random.default_rng(rng)
+    if ndata < n_model_points:
+        if verbose >= 1:
+            print("ransac_3dvector(): not enough data for a model.")
+        return None
+    # ranges of the 3 indices of a triplet, see below
+    high = np.array([ndata, ndata - 1, ndata - 2], dtype=float)
+
+    max_block = max(1, 2**17//ndata)
+    S_t = None
+    if max_iters*ndata > 1e8 and _has_torch_cuda():
+        # On a CUDA GPU, blocks are solved and scored by torch when the work 
+        # is large enough to hide the transfers, else the CPU is faster.
+        S_t = torch.as_tensor(S, device='cuda')
+        I_t = torch.as_tensor(I, device='cuda')
+        max_block = max(1, 2**23//ndata)
+    elif has_numba:
+        # else with numba, blocks are scored in parallel without storing 
+        # residuals. They are bounded as above all the same, since the 
+        # candidates scored past the first one which reaches k are wasted,
+        # but fill the threads.
+        max_block = max(max_block, get_num_threads())
+    use_numba = has_numba and S_t is None
     
-    while k > trial_count:
+    while k > trial_count and trial_count < max_iters:
         if verbose >= 2:   
             print("ransac_3dvector(): at trial ",trial_count)
 
-        i = 0
-        while i < max_data_tries:
-            # select 3 pairs s, I randomly and check whether
-            # they allow to compute a proper model: |det(s_i1, s_i2, s_i3| >> 0.
-            idx = random.sample(range(ndata), n_model_points)
-            if verbose >= 2:
-                print("ransac_3dvector(): selected indices = ", idx)
+        # select a block of triplets of pairs s, I randomly and keep those 
+        # which allow to compute a proper model: |det(s_i1, s_i2, s_i3| >> 0.
+        # no more candidates than the current estimate of needed trials, 
+        # (a single one at start, k = 1), nor than what keeps the 
+        # (n_block, ndata) residuals of the block small.
+        n_block = int(min(block_size, max_iters - trial_count, max_block,
+                          np.ceil(k - trial_count)))
+        # triplets of distinct indices, as random.sample: i1 among the 
+        # ndata-1 indices other than i0, and i2 among the ndata-2 others
+        # than i0, i1, shifted past them in increasing order.
+        # (scaled uniform floats are cheaper than integers() with bounds.)
+        if n_block == 1:
+            # a single candidate, the common case with few trials: one 
+            # triplet, with a direct det and solve, as the fixed cost of
+            # the block path below would dominate.
+            n_draw = 1
+            i0, i1, i2 = (rng.random(n_model_points)*high).astype(np.intp).tolist()
+            i1 += i1 >= i0
+            i2 += i2 >= min(i0, i1)
+            i2 += i2 >= max(i0, i1)
+            idx = [i0, i1, i2]
             s = S[idx]
-            if abs(np.linalg.det(s))>= det_threshold:
-                Is = I[idx]
-                break
-            i += 1
-        if i == max_data_tries:
-            if verbose >= 1:
-                print("ransac_3dvector(): no dataset found, degenerate model?")
-            return None
-        
-        # here, we can evaluate a candidate model
-        m = np.linalg.inv(s) @ Is
-        """
-        if np.any(np.isnan(m)) or np.any(np.isinf(m)) or (np.linalg.norm(m) < 1e-10):
-            print('Estimated vector:', m)
-            print('Data points used:', Is)
-            print('Light sub-matrix determinant', np.linalg.det(s))
-            raise ValueError('NaN of Infinite or null vector encountered.')
-        """
-
-        if verbose >= 2:
-            print("ransac_3dvector(): estimated model", m)
-        # then its inliers. For that we fist compute fitting values
-        fit = np.abs(I - S @ m)
-        inliers = np.where(fit <= threshold)[0]
-        n_inliers = len(inliers)
-        if verbose >= 2:
-            print("ransac_3dvector(): number of inliers for this model", n_inliers)
-
-        
-        if n_inliers > best_score:
-            best_score = n_inliers
-            best_inliers = inliers
-            # we reevaluate m on the inliers' subset
-            s = S[inliers]
-            Is = I[inliers]
-            best_m = np.linalg.pinv(s) @ Is
-            # This should match Yvain's version?
-            # best_m = m.copy()
-            best_fit = np.mean(np.abs(Is - s@best_m))
+            good = [0] if abs(np.linalg.det(s)) >= det_threshold else []
+        else:
+            # draw more triplets than that, from the fraction of degenerate
+            # ones so far (twice as many at start), so that a block seldom
+            # lacks proper candidates.
+            n_draw = int(min(np.ceil(n_block*(n_drawn + 2)/(n_regular + 1)),
+                             n_block*max_data_tries))
+            idx = (rng.random((n_draw, n_model_points))*high).astype(np.intp)
+            i0, i1, i2 = idx.T
+            i1 += i1 >= i0
+            i2 += i2 >= np.minimum(i0, i1)
+            i2 += i2 >= np.maximum(i0, i1)
+            # determinants and candidate models of the whole block at once
+            if S_t is not None:
+                det, M = _solve3_torch(S_t, I_t, idx)
+            elif use_numba:
+                det, M = _solve3_numba(S, I, idx)
+            else:
+                det, M = _solve3(S[idx], I[idx])
+            good = np.flatnonzero(np.abs(det) >= det_threshold)
+        n_drawn += n_draw
+        n_regular += len(good)
+        if len(good) == 0:
+            n_failed += n_draw
+            if n_failed >= max_data_tries:
+                if verbose >= 1:
+                    print("ransac_3dvector(): no dataset found, degenerate model?")
+                return None
+            continue
+        n_failed = 0
+        if n_block == 1:
+            M = np.linalg.solve(s, I[idx])[None, :]
             if verbose >= 2:
-                print("ransac_3dvector(), updating best model to", best_m)
-            
-            frac_inliers = n_inliers / ndata
-            # p_outliers is the 1 - b of Fishler-Bolles
-            # the number of needed points to select a model is 3
-            p_outliers = 1 - frac_inliers**n_model_points
-            # preveny NaN/Inf  in estimation of k
-            eps = np.spacing(p_outliers)
-            p_outliers = min(1-eps, max(eps, p_outliers))
-            k = np.log(1-p)/np.log(p_outliers)
+                print("ransac_3dvector(): selected indices = ", idx)
+        else:
+            # the first n_block proper candidates make the block
+            good = good[:n_block]
+            M = M[good]
             if verbose >= 2:
-                print("ransac_3dvector(): estimate of runs to select"
-                      " enough inliers with probability {0}: {1}".format(p, k))
+                print("ransac_3dvector(): selected indices = ", idx[good])
+        if verbose >= 2:
+            print("ransac_3dvector(): estimated models", M)
+
+        # here, we can evaluate the candidate models by their inliers,
+        # only those of the block.
+        if S_t is not None:
+            scores = _count_inliers_torch(M, S_t, I_t, threshold)
+        elif use_numba:
+            scores = _count_inliers_numba(M, S, I, threshold)
+        else:
+            scores = _count_inliers(M, S, I, threshold)
+        # Go through the candidates in order, as one trial each, so as to
+        # stop right after the first one at which enough trials were made.
+        for j, score in enumerate(scores.tolist()):
+            trial_count += 1
+            if score > best_score:
+                best_score = score
+                best_m = M[j]
+                k = _ransac_trials(score/ndata, p, n_model_points)
+                if verbose >= 2:
+                    print("ransac_3dvector(), updating best candidate to", best_m, 
+                          "with number of inliers", best_score)
+                    print("ransac_3dvector(): estimate of runs to select"
+                          " enough inliers with probability {0}: {1}".format(p, k))
+            if trial_count >= k:
+                break
 
-        trial_count += 1
-        if trial_count > max_iters:
-            if verbose:
-                print("ransac_3dvector(): reached maximum number of trials.")
-            break
+    if k > trial_count and verbose:
+        print("ransac_3dvector(): reached maximum number of trials.")
 
     if best_m is None:
         if verbose: 
             print("ransac_3dvector(): unable to find a good enough solution.")
         return None
-    else:
-        if verbose >= 2:
-            print("ransac_3dvector(): returning after {0} iterations.".format(trial_count))
-        return best_m, best_inliers, best_fit
+
+    # we reevaluate m on the inliers' subset of the best candidate
+    best_inliers = np.where(np.abs(I - S @ best_m) <= threshold)[0]
+    S_inliers = S[best_inliers]
+    I_inliers = I[best_inliers]
+    # least squares solution, same as pinv(S_inliers) @ I_inliers, cheaper
+    best_m = np.linalg.lstsq(S_inliers, I_inliers, rcond=None)[0]
+    # This should match Yvain's version?
+    # best_m = m.copy()
+    best_fit = np.mean(np.abs(I_inliers - S_inliers @ best_m))
+    if verbose >= 2:
+        print("ransac_3dvector(): returning after {0} iterations.".format(trial_count))
+    return best_m, best_inliers, best_fit
 
 
 def cdx(f):
     """
     central differences for f in x direction
     """
-    m = f.shape[0]
-    west = [0] + list(range(m-1))
-    east = list(range(1,m)) + [m-1]
-    return 0.5*(f[east,:] - f[west,:])
+    f = np.asarray(f)
+    out = np.empty(f.shape, dtype=np.result_type(f, 0.5))
+    if f.shape[0] < 2:
+        # a single row has null differences
+        out[...] = 0
+        return out
+    out[1:-1] = 0.5*(f[2:] - f[:-2])
+    out[0] = 0.5*(f[1] - f[0])
+    out[-1] = 0.5*(f[-1] - f[-2])
+    return out
     
 def cdy(f):
     """
     central differences for f in y direction
     """
-    n = f.shape[1]
-    south = [0] + list(range(n-1))
-    north = list(range(1,n)) + [n-1]
-    return 0.5*(f[:,north] - f[:,south])
+    f = np.asarray(f)
+    out = np.empty(f.shape, dtype=np.result_type(f, 0.5))
+    if f.shape[1] < 2:
+        # a single column has null differences
+        out[...] = 0
+        return out
+    out[:,1:-1] = 0.5*(f[:,2:] - f[:,:-2])
+    out[:,0] = 0.5*(f[:,1] - f[:,0])
+    out[:,-1] = 0.5*(f[:,-1] - f[:,-2])
+    return out
     
 
 def tolist(A):
@@ -266,35 +551,60 @@ def make_bc_data(mask):
         inside: linear indices of points inside the mask
         n_pixels: number of inside / in domain pixels
     """
-    m,n = mask.shape
     inside = np.where(mask)
     x, y = inside
     n_pixels = len(x)
-    m2i = -np.ones(mask.shape)
+    index = np.arange(n_pixels)
+    m2i = -np.ones(mask.shape, dtype=int)
     # m2i[i,j] = -1 if (i,j) not in domain, index of (i,j) else.
-    m2i[(x,y)] = range(n_pixels)
-    west  = np.zeros(n_pixels, dtype=int)
-    north = np.zeros(n_pixels, dtype=int)
-    east  = np.zeros(n_pixels, dtype=int)
-    south = np.zeros(n_pixels, dtype=int)
-
-   
-    for i in range(n_pixels):
-        xi = x[i]
-        yi = y[i]
-        wi = x[i] - 1
-        ni = y[i] + 1
-        ei = x[i] + 1
-        si = y[i] - 1
-
-        west[i]  = m2i[wi,yi] if (wi > 0) and (mask[wi, yi] > 0) else i
-        north[i] = m2i[xi,ni] if (ni < n) and (mask[xi, ni] > 0) else i
-        east[i]  = m2i[ei,yi] if (ei < m) and (mask[ei, yi] > 0) else i
-        south[i] = m2i[xi,si] if (si > 0) and (mask[xi, si] > 0) else i
+    m2i[(x,y)] = index
+    # surround it by a ring of -1, so that neighbours of pixels on the 
+    # image border are out of domain. (i,j) is at (i+1,j+1) in m2i.
+    m2i = np.pad(m2i, 1, mode='constant', constant_values=-1)
+
+    west  = m2i[x, y+1]
+    north = m2i[x+1, y+2]
+    east  = m2i[x+2, y+1]
+    south = m2i[x+1, y]
+
+    # a neighbour out of domain is replaced by the point itself
+    west  = np.where(west  >= 0, west,  index)
+    north = np.where(north >= 0, north, index)
+    east  = np.where(east  >= 0, east,  index)
+    south = np.where(south >= 0, south, index)
 
     return west, north, east, south, inside, n_pixels
 
 
+@functools.lru_cache(maxsize=8)
+def _cached_bc_data(inside_bytes, shape):
+    """
+    make_bc_data() for the mask given by the raw content inside_bytes of 
+    the boolean (m,n) array mask != 0, with m, n = shape. As it is cached, 
+    for repeated smoothing / regularisation on the same domain, the arrays 
+    are read only.
+    """
+    inside = np.frombuffer(inside_bytes, dtype=bool).reshape(shape)
+    bc_list = make_bc_data(inside)
+    for a in bc_list[:4] + bc_list[4]:
+        a.setflags(write=False)
+    return bc_list
+
+
+def _stencil_matrix(west, north, east, south):
+    """
+    5-point Laplacian stencil with the null Neumann BC of make_bc_data()
+    as a sparse matrix L, i.e., for a (n_pixels, k) field N,
+    L @ N = N[west] + N[north] + N[east] + N[south] - 4*N
+    """
+    n_pixels = len(west)
+    index = np.arange(n_pixels)
+    rows = np.tile(index, 5)
+    cols = np.concatenate((west, north, east, south, index))
+    data = np.concatenate((np.ones(4*n_pixels), -4.0*np.ones(n_pixels)))
+    return sp.csr_matrix((data, (rows, cols)), shape=(n_pixels, n_pixels))
+
+
 def project_orthogonal(p, n):
     """
     Project p orthogonally on the orthogonal of n, i.e.,
@@ -344,6 +654,87 @@ def sphere_Exp_map(v, n, eps=1e-7):
     return n*cv + vhat*sv
     
 
+def _tangent_exp_step(N, v, tau, out, eps=1e-7):
+    """
+    Descent step out = Exp_N(tau*(v - (v.N)N)) of the smoothing functions,
+    i.e., project_orthogonal() followed by sphere_Exp_map(), with in place
+    operations: only per pixel scalars are allocated. v is overwritten,
+    out must not be N.
+    """
+    h = np.einsum('ij,ij->i', v, N)
+    np.multiply(N, h[:, None], out=out)
+    v -= out
+    v *= tau
+    nv = np.sqrt(np.einsum('ij,ij->i', v, v))
+    cv = np.cos(nv)
+    sv = np.sin(nv)
+    # to avoid division by 0, when |nv| is < eps, replace by 1
+    np.place(nv, nv < eps, 1.0)
+    sv /= nv
+    np.multiply(N, cv[:, None], out=out)
+    v *= sv[:, None]
+    out += v
+    return out
+
+
+def _unpack_normal_field(N, inside, shape):
+    """
+    Components n1, n2, n3 as (m,n) arrays of a (n_pixels, 3) normal field 
+    N defined on the pixels inside of the domain, see make_bc_data(). 
+    They are NaN outside of the domain, where the field is not defined.
+    """
+    out = np.full((3,) + shape, np.nan)
+    out[:, inside[0], inside[1]] = N.T
+    return out[0], out[1], out[2]
+
+
+if has_numba:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _normal_field_step(N, N0, west, north, east, south, mu, tau, out):
+        """
+        One descent step of smooth_normal_field() (mu = 0) or 
+        tichonov_regularisation_normal_field() fused in a single pass
+        over the pixels: tension, distance term, projection on the tangent
+        plane and exponential map, written to out.
+        """
+        for i in prange(N.shape[0]):
+            w, nn, e, s = west[i], north[i], east[i], south[i]
+            n0, n1, n2 = N[i, 0], N[i, 1], N[i, 2]
+            # Tension (a.k.a vector-valued Laplace Beltrami on proper bundle)
+            v0 = N[w, 0] + N[nn, 0] + N[e, 0] + N[s, 0] - 4.0*n0
+            v1 = N[w, 1] + N[nn, 1] + N[e, 1] + N[s, 1] - 4.0*n1
+            v2 = N[w, 2] + N[nn, 2] + N[e, 2] + N[s, 2] - 4.0*n2
+
+            # distance derived term, theta/sin(theta), theta angle (N, N0)
+            if mu != 0.0:
+                m0, m1, m2 = N0[i, 0], N0[i, 1], N0[i, 2]
+                c0 = n1*m2 - n2*m1
+                c1 = n2*m0 - n0*m2
+                c2 = n0*m1 - n1*m0
+                theta = np.arctan2(np.sqrt(c0*c0 + c1*c1 + c2*c2), n0*m0 + n1*m1 + n2*m2)
+                dterm = mu
+                if theta > 0.0:
+                    dterm = mu*theta/np.sin(theta)
+                v0 += dterm*N0[i, 0]
+                v1 += dterm*N0[i, 1]
+                v2 += dterm*N0[i, 2]
+
+            # projection on the orthogonal of N and Riemannian Exponential map
+            h = v0*n0 + v1*n1 + v2*n2
+            v0 = tau*(v0 - h*n0)
+            v1 = tau*(v1 - h*n1)
+            v2 = tau*(v2 - h*n2)
+            nv = np.sqrt(v0*v0 + v1*v1 + v2*v2)
+            cv = np.cos(nv)
+            sv = np.sin(nv)
+            if nv < 1e-7:
+                nv = 1.0
+            sv = sv/nv
+            out[i, 0] = n0*cv + v0*sv
+            out[i, 1] = n1*cv + v1*sv
+            out[i, 2] = n2*cv + v2*sv
+
+
 def smooth_normal_field(n1, n2, n3, mask, bc_list=None, iters=100, tau=0.05, verbose=False):
     """
     Runs a few iterations of a minimization of 2-norm squared
@@ -369,40 +760,41 @@ def smooth_normal_field(n1, n2, n3, mask, bc_list=None, iters=100, tau=0.05, ver
 
     Returns:
     --------
-    Smoothed version of field (n1, n2, n3)
+    Smoothed version of field (n1, n2, n3), NaN outside of mask.
 
     
     """
     if bc_list is None:
-        bc_list = make_bc_data(mask)
+        bc_list = _cached_bc_data(mask.astype(bool).tobytes(), mask.shape)
     west, north, east, south, inside, n_pixels = bc_list
     N = np.zeros((n_pixels, 3))
     N[:,0] = n1[inside]
     N[:,1] = n2[inside]
     N[:,2] = n3[inside]
 
+    N_next = np.empty_like(N)
+    if not has_numba:
+        L = _stencil_matrix(west, north, east, south)
+
     for i in range(iters):
         if verbose:
             sys.stdout.write(f'\rsmoothing iteration {i} out of {iters}\t')
-        # Tension (a.k.a vector-valued Laplace Beltrami on proper bundle)
-        v3 = N[west] + N[north] + N[east] + N[south] - 4.0*N
-
-        grad = project_orthogonal(v3, N)
-        # Riemannian Exponential map for evolution
-        N = sphere_Exp_map(tau*grad, N)
+        if has_numba:
+            _normal_field_step(N, N, west, north, east, south, 0.0, tau, N_next)
+            N, N_next = N_next, N
+        else:
+            # Tension (a.k.a vector-valued Laplace Beltrami on proper bundle)
+            v3 = L @ N
+
+            # projection on the tangent plane and Riemannian Exponential 
+            # map for evolution
+            _tangent_exp_step(N, v3, tau, N_next)
+            N, N_next = N_next, N
 
     if verbose:
         print('\n')
 
-    N = N.T
-    N1 = np.zeros(mask.shape)
-    N2 = np.zeros(mask.shape)
-    N3 = np.ones(mask.shape)
-
-    N1[inside] = N[0]
-    N2[inside] = N[1]
-    N3[inside] = N[2]
-    return N1, N2, N3
+    return _unpack_normal_field(N, inside, mask.shape)
 
 
 def tichonov_regularisation_normal_field(n1, n2, n3, mu, mask, bc_list = None, 
@@ -416,7 +808,7 @@ def tichonov_regularisation_normal_field(n1, n2, n3, mu, mask, bc_list = None,
     ----------
     n1, n2, n3: numpy arrays
         the x, y and z components of the normal field n=(n1,n2,n3). 
-        Should satisfy n1**2 + n2**2 + n3**2 = 1
+        Should satisfy n1**2 + n2**2 + n3**2 = 1, it is normalised else.
     mu: float
         weight of the data term
     mask: numpy array
@@ -430,13 +822,16 @@ def tichonov_regularisation_normal_field(n1, n2, n3, mu, mask, bc_list = None,
     tau: float
         descent time step
     eps: float
-        default 1e-7: to avoid indetermined form in arcos(x)/sqrt(1-x^2)
-        when x too closed to 1. The case x -> -1 is excluded, it would 
-        mean a maximum change in local value of vector field !
+        not used anymore, kept for compatibility. It was used to avoid 
+        the indetermined form in arcos(x)/sqrt(1-x^2) when x too closed 
+        to 1, the term is now computed as theta/sin(theta) with theta 
+        angle between n and n0, which is stable there. The case x -> -1
+        is excluded, it would mean a maximum change in local value of 
+        vector field !
 
     Returns:
     --------
-        n1, n2, n3: regularised field
+        n1, n2, n3: regularised field, NaN outside of mask.
 
 
     """
@@ -446,51 +841,83 @@ def tichonov_regularisation_normal_field(n1, n2, n3, mu, mask, bc_list = None,
             warnings.filterwarnings('ignore', r'divide by zero encountered in true_divide')
 
     if bc_list is None:
-        bc_list = make_bc_data(mask)
+        bc_list = _cached_bc_data(mask.astype(bool).tobytes(), mask.shape)
     west, north, east, south, inside, n_pixels = bc_list
 
     N = np.zeros((n_pixels, 3)) 
     N[:,0] = n1[inside]
     N[:,1] = n2[inside]
     N[:,2] = n3[inside]
+    # normalised once, so that both the numba kernel and the half chord
+    # below get the same angle between N and N0 on slightly non unit 
+    # input.
+    norm = np.sqrt(np.einsum('ij,ij->i', N, N))
+    np.divide(N, norm[:, None], out=N, where=norm[:, None] > 0)
     N0 = N.copy()
-    dterm= np.zeros(n_pixels)
+    N_next = np.empty_like(N)
+    if not has_numba:
+        L = _stencil_matrix(west, north, east, south)
+        # buffers of the distance term, reused at each iteration
+        chord2 = np.empty(n_pixels)
+        chord = np.empty(n_pixels)
+        theta = np.empty(n_pixels)
+        dterm = np.empty(n_pixels)
+        d3 = np.empty_like(N)
 
     for i in range(iters):
         if verbose:
             sys.stdout.write('\rTichonov iteration {0} out of {1}\t'.format(i, iters))
-        
-        # Tension (a.k.a vector-valued Laplace Beltrami on proper bundle)
-        v3 = N[west] + N[north] + N[east] + N[south] -4.0*N
-
-        # distance derived term
-        NN0 = ((N*N0).sum(axis=1)) # (N.N0)
-        NN02 = NN0**2
-        np.place(NN02, NN02 > 1.0, 1.0)
-        unstable = np.where(NN02 >= 1-eps)
-        #stable = np.where(NN02 <= 1-eps)
-        
-        dterm = np.arccos(NN0)/np.sqrt(1-NN02) 
-        dterm[unstable] = 0.0
-        d3 = np.reshape(dterm, (-1,1))*N0
-
-        grad = project_orthogonal(mu*d3 + v3, N)
-        N = sphere_Exp_map(tau*grad, N)
+        if has_numba:
+            _normal_field_step(N, N0, west, north, east, south, mu, tau, N_next)
+            N, N_next = N_next, N
+        else:
+            # Tension (a.k.a vector-valued Laplace Beltrami on proper bundle)
+            v3 = L @ N
+
+            # distance derived term: theta/sin(theta) = arccos(x)/sqrt(1-x^2),
+            # x = N.N0, with theta the angle between the unit vectors N and 
+            # N0, from the half chord c = |N - N0|/2: theta/2 = arcsin(c), 
+            # sin(theta)/2 = c*sqrt(1 - c^2). Limit 1 at theta = 0.
+            np.subtract(N, N0, out=d3)
+            np.einsum('ij,ij->i', d3, d3, out=chord2)
+            chord2 *= 0.25
+            np.minimum(chord2, 1.0, out=chord2)
+            np.sqrt(chord2, out=chord)
+            np.arcsin(chord, out=theta) # theta/2
+            np.subtract(1.0, chord2, out=chord2)
+            np.sqrt(chord2, out=chord2)
+            chord2 *= chord # sin(theta)/2
+            dterm.fill(1.0)
+            np.divide(theta, chord2, out=dterm, where=theta > 0)
+            dterm *= mu
+            np.multiply(N0, dterm[:, None], out=d3)
+
+            v3 += d3
+            _tangent_exp_step(N, v3, tau, N_next)
+            N, N_next = N_next, N
         
     if verbose:
         print('\n')
 
-    N = N.T
-    N1 = np.zeros(mask.shape)
-    N2 = np.zeros(mask.shape)
-    N3 = np.ones(mask.shape)
+    return _unpack_normal_field(N, inside, mask.shape)
 
-    N1[inside] = N[0]
-    N2[inside] = N[1]
-    N3[inside] = N[2]
-    return N1, N2, N3
 
 
+@functools.lru_cache(maxsize=8)
+def _dct_laplacian_inverse(m, n):
+    """
+    Inverses of the eigenvalues of the discrete Laplacian on the DCT basis
+    of (m,n) arrays, used by simchony_integrate(). The null eigenvalue, of 
+    the constant mode, gets a 0 inverse. Read only, as it is cached.
+    """
+    x, y = np.mgrid[0:m,0:n]
+    denum = (2*np.cos(np.pi*x/m) - 2) + (2*np.cos(np.pi*y/n) -2)
+    denum[0,0] = 1.0
+    inverse = 1.0/denum
+    inverse[0,0] = 0.0
+    inverse.setflags(write=False)
+    return inverse
+
 
 def simchony_integrate(n1, n2, n3, mask):
     """
@@ -550,15 +977,13 @@ def simchony_integrate(n1, n2, n3, mask):
 
     # cosine transform f (reflective conditions, a la matlab, 
     # might need some check)
-    fs = fft.dctn(f, norm='ortho')
+    fs = fft.dctn(f, type=2, norm='ortho', workers=-1)
     
-    x, y = np.mgrid[0:m,0:n]
-    denum = (2*np.cos(np.pi*x/m) - 2) + (2*np.cos(np.pi*y/n) -2)
-    Z = fs/denum
-    Z[0,0] = 0.0 
+    # Z[0,0] = 0.0 via the cached inverse denominator
+    Z = fs*_dct_laplacian_inverse(m, n)
     # or what Yvain proposed, it does not really matters
     # Z[0,0] = Z[1,0] + Z[0,1]
-    z = fft.idctn(Z, norm='ortho')
+    z = fft.idctn(Z, type=2, norm='ortho', workers=-1)
     # fill outside with Nan, i.e., undefined.
     z[np.where(mask == 0)] = np.nan
     return z
@@ -568,6 +993,68 @@ def simchony_integrate(n1, n2, n3, mask):
 
 
 
+# Above this number of unknowns, the Poisson system of unbiased_integrate()
+# is solved by preconditioned conjugate gradients instead of a sparse 
+# factorization, whose fill-in grows faster than the domain.
+_max_direct_unknowns = 10**6
+
+
+@functools.lru_cache(maxsize=4)
+def _poisson_solver(inside_bytes, shape):
+    """
+    Factorization of the system matrix of unbiased_integrate() for a mask.
+    It only depends on the mask, so it is cached, keyed by the mask content,
+    for repeated integrations on the same domain.
+    Arguments:
+    ----------
+    inside_bytes: bytes
+        raw content of the boolean (m,n) array mask > 0
+    shape: tuple
+        (m,n)
+    Returns:
+    --------
+        solve: function such that solve(b) is the solution of Az = b.
+        A sparse Cholesky factor (CHOLMOD) if scikit-sparse is available, 
+        a sparse LU factor else. For large domains, conjugate gradients
+        preconditioned by algebraic multigrid (pyamg) if available, by the
+        diagonal of A else.
+    """
+    m,n = shape
+    inside = np.frombuffer(inside_bytes, dtype=bool).reshape(shape)
+
+    # A is the graph Laplacian of the grid of 4-neighbours
+    # restricted to the mask, i.e., the neg-Laplacian with null Neumann BC:
+    # degree on the diagonal, -1 for each pair of neighbors in mask.
+    adjacency = sp.kronsum(sp.diags([1.0, 1.0], [-1, 1], shape=(n, n)),
+                           sp.diags([1.0, 1.0], [-1, 1], shape=(m, m)), format='csr')
+    inside_flat = inside.ravel()
+    adjacency = adjacency[inside_flat][:, inside_flat]
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    A = (sp.diags(degree + 1e-9) - adjacency).tocsc()
+
+    if A.shape[0] > _max_direct_unknowns:
+        A = A.tocsr()
+        if has_pyamg:
+            M = smoothed_aggregation_solver(A).aspreconditioner()
+        else:
+            M = sp.diags(1.0/A.diagonal())
+
+        def solve(b):
+            z, info = cg(A, b, M=M, **{_cg_tol_keyword: 1e-8})
+            if info > 0:
+                warnings.warn("unbiased_integrate(): conjugate gradients did not "
+                              "converge in {0} iterations.".format(info))
+            elif info < 0:
+                warnings.warn("unbiased_integrate(): conjugate gradients broke "
+                              "down (info = {0}).".format(info))
+            return z
+        return solve
+
+    if has_cholmod:
+        return cholesky(A)
+    return factorized(A)
+
+
 def unbiased_integrate(n1, n2, n3, mask, order=2):
     """
     Constructs the finite difference matrix, domain and other information
@@ -604,93 +1091,33 @@ def unbiased_integrate(n1, n2, n3, mask, order=2):
     p = -n2/n3
     q = -n1/n3        
     
-    # Calculate some usefuk masks
     m,n = mask.shape
-    Omega = np.zeros((m,n,4))
-    Omega_padded = np.pad(mask, (1,1), mode='constant', constant_values=0)
-    Omega[:, :, 0] = Omega_padded[2:, 1:-1]*mask   # value 1 iff bottom neighbor also in mask
-    Omega[:, :, 1] = Omega_padded[:-2, 1:-1]*mask  # value 1 iff top neighbor also in mask
-    Omega[:, :, 2] = Omega_padded[1:-1, 2:]*mask   # value 1 iff right neighbor also in mask
-    Omega[:, :, 3] = Omega_padded[1:-1, :-2]*mask  # value 1 iff left neighbor also in mask
-    del Omega_padded
-    
-    # Mapping between 2D indices and an linear indices of
-    # pixels inside the mask
-    indices_mask = np.where(mask > 0)
-    lidx = len(indices_mask[0])
-    mapping_matrix = np.zeros(p.shape, dtype=int)
-    mapping_matrix[indices_mask] = list(range(lidx))
+    inside = mask > 0
+    
+    # 2D indices of pixels inside the mask, in the same (row major)
+    # order as the unknowns of the system
+    indices_mask = np.where(inside)
     
     if order == 1:
         pbar = p.copy()
         qbar = q.copy()
     elif order == 2:
-        pbar = 0.5*(p + p[list(range(1,m)) + [m-1], :])  # p <- (p + south(p))/2
-        qbar = 0.5*(q + q[:, list(range(1,n)) + [n-1]])  # q <- (q + east(q))/2
+        # south / east neighbours, the last row / column repeated.
+        pbar = 0.5*(p + np.concatenate((p[1:, :], p[-1:, :]), axis=0))  # p <- (p + south(p))/2
+        qbar = 0.5*(q + np.concatenate((q[:, 1:], q[:, -1:]), axis=1))  # q <- (q + east(q))/2
         
-    # System
-    I = []
-    J = []
-    K = []
-    b = np.zeros(lidx)
-
-    # In mask, right neighbor also in mask
-    rset = Omega[:,:,2]
-    X, Y = np.where(rset > 0)
-    I_center = mapping_matrix[(X,Y)].astype(int)
-    I_neighbors = mapping_matrix[(X,Y+1)]
-    lic = len(X)
-    A_center = np.ones(lic)
-    A_neighbors = -A_center
-    K += tolist(A_center) + tolist(A_neighbors)
-    I += tolist(I_center) + tolist(I_center)
-    J += tolist(I_center) + tolist(I_neighbors)
-    b[I_center] -= qbar[(X,Y)]
-
-    # In mask, left neighbor in mask
-    lset = Omega[:,:,3]
-    X, Y = np.where(lset > 0)
-    I_center = mapping_matrix[(X,Y)].astype(int)
-    I_neighbors = mapping_matrix[(X,Y-1)]
-    lic = len(X)
-    A_center = np.ones(lic)
-    A_neighbors = -A_center
-    K += tolist(A_center) + tolist(A_neighbors)
-    I += tolist(I_center) + tolist(I_center)
-    J += tolist(I_center) + tolist(I_neighbors)  
-    b[I_center] += qbar[(X,Y-1)]
-
-    # In mask, top neighbor in mask
-    tset = Omega[:,:,1]
-    X, Y = np.where(tset > 0)
-    I_center = mapping_matrix[(X,Y)].astype(int)
-    I_neighbors = mapping_matrix[(X-1,Y)]
-    lic = len(X)
-    A_center = np.ones(lic)
-    A_neighbors = -A_center
-    K += tolist(A_center) + tolist(A_neighbors)
-    I += tolist(I_center) + tolist(I_center)
-    J += tolist(I_center) + tolist(I_neighbors)
-    b[I_center] += pbar[(X-1,Y)]
-
-    #	In mask, bottom neighbor in mask
-    bset = Omega[:,:,0]
-    X, Y = np.where(bset > 0)
-    I_center = mapping_matrix[(X,Y)].astype(int)
-    I_neighbors = mapping_matrix[(X+1,Y)]
-    lic = len(X)
-    A_center = np.ones(lic)
-    A_neighbors = -A_center
-    K += tolist(A_center) + tolist(A_neighbors)
-    I += tolist(I_center) + tolist(I_center)
-    J += tolist(I_center) + tolist(I_neighbors)
-    b[I_center] -= pbar[(X,Y)]
-    
-    # Construction de A (compressed sparse column matrix)
-    A = sp.csc_matrix((K, (I, J)))
-    A = A + sp.eye(A.shape[0])*1e-9
-    z = np.nan*np.ones(mask.shape)
-    z[indices_mask] = spsolve(A, b)
+    # b is the neg divergence of (pbar, qbar), as the sum of fluxes 
+    # through edges between pixels in mask, qbar on (x,y)-(x,y+1),
+    # pbar on (x,y)-(x+1,y).
+    flux_q = np.where(inside[:, :-1] & inside[:, 1:], qbar[:, :-1], 0.0)
+    flux_p = np.where(inside[:-1, :] & inside[1:, :], pbar[:-1, :], 0.0)
+    div = (np.diff(np.pad(flux_q, ((0, 0), (1, 1))), axis=1) + 
+           np.diff(np.pad(flux_p, ((1, 1), (0, 0))), axis=0))
+    b = -div[indices_mask]
+    
+    solve = _poisson_solver(inside.tobytes(), inside.shape)
+    z = np.full(mask.shape, np.nan)
+    z[indices_mask] = solve(b)
     return z
     
 